@@ -1,24 +1,180 @@
 #!/usr/bin/python3
 import cv2
 import numpy as np
-import random
+import hashlib
 import math
-from message import Message
+import itertools
+import os
+import glob
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from message import Message, PayloadWriter, CHUNK_BLOCKS, BLOCK_BITS, HEADER_THRESHOLD, WC, block_complexity
 
 def psnr(img1, img2):
 	rms = math.sqrt(np.sum((img1.astype('float') - img2.astype('float')) ** 2) / (img1.shape[1] * img1.shape[0]))
 	return 20 * math.log10(256 / rms)
 
+class SteganographyException(Exception):
+	pass
+
+class ComplexityCache(object):
+	"""Complexity maps of covers kept on disk as border change counts
+	(uint8 .npy files), keyed by a hash of the pixels so a changed image
+	never hits an old entry. Least recently used files are removed once the
+	directory is bigger than max_bytes
+	"""
+
+	def __init__(self, directory, max_bytes = 256 * 2 ** 20):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		os.makedirs(directory, exist_ok = True)
+
+	def key(self, img, cgc = False):
+		"""cgc: the map is of the Gray coded planes, another entry
+		"""
+		digest = hashlib.sha256((str((img.shape, img.dtype.str)) + (' cgc' if cgc else '')).encode('utf-8'))
+		# per potongan baris, gambar memmap tidak disalin utuh
+		for top in range(0, img.shape[0], 256):
+			digest.update(np.ascontiguousarray(img[top:top + 256]).data)
+		return digest.hexdigest()
+
+	def path(self, key):
+		return os.path.join(self.directory, key + '.npy')
+
+	def get(self, key):
+		"""Cached counts, or None
+		"""
+		try:
+			counts = np.load(self.path(key))
+			os.utime(self.path(key)) # tandai baru dipakai
+		except (OSError, ValueError):
+			return None
+		return counts
+
+	def put(self, key, counts):
+		# file sementara unik, dua proses yang menyimpan cover yang sama tidak saling menimpa
+		fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				np.save(f, counts.astype(np.uint8))
+			os.replace(tmp, self.path(key))
+		except BaseException:
+			os.remove(tmp)
+			raise
+		self.evict()
+
+	def evict(self):
+		entries = []
+		for path in glob.glob(os.path.join(self.directory, '*.npy')):
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+		entries.sort()
+		total = sum(size for _, size, _ in entries)
+		for _, size, path in entries:
+			if total <= self.max_bytes: break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
+
+def open_image(path, mode = 'r', shape = None):
+	"""Map an uncompressed image file in memory instead of decoding it, for
+	BPCS(open_image(...)) and hide_tiled on images bigger than the RAM.
+	Supports .npy uint8 arrays, 24 bits BMP and raw uint8 dumps (shape
+	required)
+	"""
+	ext = os.path.splitext(path)[1].lower()
+	if (ext == '.npy'):
+		img = np.load(path, mmap_mode = mode)
+		if (img.dtype != np.uint8):
+			raise SteganographyException("Only uint8 arrays can be used as image")
+		return img
+	if (ext == '.bmp'):
+		header = np.fromfile(path, np.uint8, 54)
+		offset = int(header[10:14].view('<u4')[0])
+		width, height = (int(v) for v in header[18:26].view('<i4'))
+		bitcount, compression = int(header[28:30].view('<u2')[0]), int(header[30:34].view('<u4')[0])
+		if (bitcount != 24 or compression != 0):
+			raise SteganographyException("Only uncompressed 24 bits BMP can be memory mapped")
+		# baris BMP dibulatkan ke 4 byte dan disimpan dari bawah
+		stride = (width * 3 + 3) // 4 * 4
+		mm = np.memmap(path, np.uint8, mode, offset, (abs(height), stride))
+		img = mm[:, :width * 3].reshape(abs(height), width, 3)
+		return img[::-1] if height > 0 else img
+	if (shape is None):
+		raise SteganographyException("Raw images need an explicit shape")
+	return np.memmap(path, np.uint8, mode, shape = tuple(shape))
+
+def create_image(path, shape):
+	"""New image file of shape mapped in memory, same formats as open_image
+	(a BMP needs 3 channels), e.g. the output of hide_tiled
+	"""
+	ext = os.path.splitext(path)[1].lower()
+	if (ext == '.npy'):
+		return np.lib.format.open_memmap(path, 'w+', np.uint8, tuple(shape))
+	if (ext == '.bmp'):
+		if (len(shape) != 3 or shape[2] != 3):
+			raise SteganographyException("Only 3 channel images can be written as BMP")
+		height, width = shape[0], shape[1]
+		size = (width * 3 + 3) // 4 * 4 * height
+		with open(path, 'wb') as f:
+			f.write(struct.pack('<2sIHHIIiiHHIIiiII', b'BM', 54 + size, 0, 0, 54, 40, width, height, 1, 24, 0, size, 2835, 2835, 0, 0))
+			f.truncate(54 + size)
+		return open_image(path, 'r+')
+	return np.memmap(path, np.uint8, 'w+', shape = tuple(shape))
+
 class BPCS(object):
 
-	def __init__(self, img_path):
-		self.img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+	def __init__(self, img_path, cache = None, cgc = False):
+		"""img_path can also be an image already loaded, used in place.
+		cache: optional ComplexityCache shared between runs. cgc: work on the
+		Canonical Gray Code planes instead of the pure binary ones, the image
+		must be read with the same setting
+		"""
+		if (isinstance(img_path, np.ndarray)):
+			self.img = img_path
+		else:
+			self.img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
 		self.row, self.col = self.img.shape[0], self.img.shape[1]
+		self.cache = cache
+		self.cgc = cgc
 
 	def generate_seed(self, key):
-		"""Generate random seed based on key
+		"""Generate random seed based on key, SHA-256 so that every byte
+		and its position count
+		"""
+		return int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest(), 'big')
+
+	def key_generator(self, randomize, key):
+		"""Generator of the cell orders for this call, None without randomize
 		"""
-		return sum([ord(a) for a in key])
+		return np.random.default_rng(self.generate_seed(key)) if randomize else None
+
+	def block_permutations(self, rng, n):
+		"""Cell order of the next n blocks, (n, 64) array. Cell 0, the
+		conjugation flag, stays in place. The stream does not depend on how
+		it is split into calls
+		"""
+		orders = np.zeros((n, 64), np.intp)
+		orders[:, 1:] = 1 + np.argsort(rng.random((n, 63)), axis=1)
+		return orders
+
+	def shuffle_blocks(self, blocks, rng, threshold):
+		"""Shuffle the cells of (n, 64) message blocks like put_msg_randomly,
+		then conjugate again the blocks the shuffle made too simple
+		"""
+		blocks = blocks.copy()
+		blocks[blocks[:, 0] == 1] ^= WC.reshape(64)
+		shuffled = np.empty_like(blocks)
+		np.put_along_axis(shuffled, self.block_permutations(rng, len(blocks)), blocks, axis=1)
+		shuffled[block_complexity(shuffled.reshape(-1, 8, 8)) < threshold] ^= WC.reshape(64)
+		return shuffled
 
 	def get_row_col(self, sequence_number):
 	    row = (sequence_number) // 8
@@ -47,88 +203,538 @@ class BPCS(object):
 				i += 1
 		return np.array(msg_bitplane)
 
-	def hide(self, message, threshold = 0.3, randomize = False, key = None):
-		windowsize_r = 8
-		windowsize_c = 8
-
-		if (randomize):
-			random.seed(self.generate_seed(key))
+	def hide(self, message, threshold = 0.3, randomize = False, key = None, parallel = False, workers = None):
+		"""threshold = 'auto' uses the highest threshold the message still
+		fits in, message must then be a Message. A Message is conjugated with
+		the threshold used and records it in its header block either way,
+		prebuilt blocks must match it. parallel embeds stripes of block rows in
+		workers processes, same result as the serial order
+		"""
+		if (parallel):
+			return self.hide_parallel(message, threshold, randomize, key, workers)
+		rng = self.key_generator(randomize, key)
 
 		#print("lenmsg", len(message))
 
-		msg_iterator = 0
-		while(msg_iterator < len(message)):
-			for row in range(0,self.row - windowsize_r + 1, windowsize_r):
-				for col in range(0,self.col - windowsize_c + 1, windowsize_c):
-					temp_block = self.img[row:row+windowsize_r, col:col+windowsize_c]
-					channels_block = cv2.split(temp_block)
-
-					channels_bitplane = [self.to_bitplane(block) for block in channels_block]
-					for i in range(len(channels_bitplane)):
-						itr_bitplane = 0
-						while(itr_bitplane < len(channels_bitplane[i]) and msg_iterator < len(message)):
-							if(self.calculate_complexity(channels_bitplane[i][itr_bitplane]) >= threshold):
-								if (randomize):
-									rand_sequence = random.sample(range(64),64)
-									#print(rand_sequence)
-									channels_bitplane[i][itr_bitplane] = self.put_msg_randomly(channels_bitplane[i][itr_bitplane], message[msg_iterator], rand_sequence)
-								else:
-									channels_bitplane[i][itr_bitplane] = message[msg_iterator]
-								msg_iterator += 1
-								# if (msg_iterator < 5):
-									# print("put at", row, col, i, itr_bitplane)
-
-							itr_bitplane += 1
-
-					new_channels = [self.bitplane_to_channel(bitplane) for bitplane in channels_bitplane]
-
-					# gabungin ke gambar utuh
-					temp_block = cv2.merge(new_channels)
-
-					# rewrite gambar asli dengan informasi rahasia
-					self.img[row:row+windowsize_r, col:col+windowsize_c] = temp_block
-
-				#kotor tapi bodo amat
-				if(msg_iterator >= len(message)): break
-
-			if(msg_iterator >= len(message)): break
+		# peta kompleksitas dari cache kalau ada, bitplane hanya dibuat untuk blok yang diubah
+		counts = self.cover_counts()
+		complexity = counts / 112
+		message, threshold, header_threshold = self.prepare_message(message, threshold, counts)
+
+		# header di bitplane kompleks pertama, pesan di bitplane kompleks sesudahnya
+		header_slot, slots = self.embedding_slots(complexity, threshold, header_threshold)
+		capacity = 0 if header_slot is None else 1 + len(slots)
+		# blok pesan selalu cukup kompleks, jadi satu putaran sudah cukup
+		if (hasattr(message, '__len__') and len(message) > capacity):
+			raise SteganographyException("Message needs %d blocks, image only has %d" % (len(message), capacity))
+
+		# message boleh list, Message atau generator, diambil sedikit-sedikit
+		message = iter(message)
+		header = next(message, None)
+		if (header is None):
+			return self.img
+		if (header_slot is None):
+			raise SteganographyException("Image has no block complex enough")
+		header = np.array(header, dtype=np.uint8).reshape(1, 64)
+		if (rng is not None):
+			header = self.shuffle_blocks(header, rng, max(threshold, header_threshold))
+		undo = [self.embed_blocks(np.array([header_slot]), header)]
+
+		for start in range(0, len(slots), CHUNK_BLOCKS):
+			wanted = min(CHUNK_BLOCKS, len(slots) - start)
+			msg_blocks = np.array(list(itertools.islice(message, wanted)), dtype=np.uint8).reshape(-1, 64)
+			if (rng is not None):
+				msg_blocks = self.shuffle_blocks(msg_blocks, rng, threshold)
+			undo.append(self.embed_blocks(slots[start:start + len(msg_blocks)], msg_blocks))
+			if(len(msg_blocks) < wanted): break
+		else:
+			# generator tanpa len, kembalikan gambar seperti semula
+			if (next(message, None) is not None):
+				pixels = self.pixel_blocks()
+				for where, values in reversed(undo):
+					pixels[where] = values
+				raise SteganographyException("Message needs more than the %d blocks of the image" % capacity)
+
 		return self.img
 
-	def show(self, threshold = 0.3, randomize = False, key = None):
-		windowsize_r = 8
-		windowsize_c = 8
+	def hide_tiled(self, message, output = None, threshold = 0.3, randomize = False, key = None, strip_rows = 8):
+		"""hide for images bigger than the RAM, e.g. mapped with open_image:
+		the image is processed strip_rows rows of blocks at a time and every
+		finished strip is written to output, an image of the same shape such
+		as create_image gives, or to self.img when output is None. Only the
+		complexity counts (an eighth of the image) and one strip are held at
+		once. Same result as hide
+		"""
+		output = self.img if output is None else output
+		rng = self.key_generator(randomize, key)
+		counts = self.cover_counts(strip_rows)
+		message, threshold, header_threshold = self.prepare_message(message, threshold, counts)
+
+		capacity = self.counts_capacity(counts, threshold, strip_rows)
+		if (hasattr(message, '__len__') and len(message) > capacity):
+			raise SteganographyException("Message needs %d blocks, image only has %d" % (len(message), capacity))
+
+		message = iter(message)
+		header = next(message, None)
+		if (header is not None):
+			header = np.array(header, dtype=np.uint8).reshape(1, 64)
+			if (rng is not None):
+				header = self.shuffle_blocks(header, rng, max(threshold, header_threshold))
+		done = header is None
+		rows = counts.shape[2]
+		for top in range(0, max(rows, 1), strip_rows):
+			bottom = min(top + strip_rows, rows)
+			# strip terakhir ikut membawa baris sisa yang tidak jadi blok
+			end = bottom * 8 if bottom < rows else self.row
+			if (output is not self.img):
+				output[top * 8:end] = self.img[top * 8:end]
+			if (done): continue
+			strip = BPCS(output[top * 8:bottom * 8], cgc = self.cgc)
+			ordered = counts[:, :, top:bottom].transpose(2, 3, 1, 0)
+			flat = ordered.reshape(-1)
+			start = 0
+			if (header is not None):
+				candidates = np.flatnonzero(flat / 112 >= header_threshold)
+				if (not len(candidates)): continue
+				strip.embed_blocks(np.array([np.unravel_index(candidates[0], ordered.shape)]), header)
+				header = None
+				start = candidates[0] + 1
+			index = start + np.flatnonzero(flat[start:] / 112 >= threshold)
+			for first in range(0, len(index), CHUNK_BLOCKS):
+				wanted = min(CHUNK_BLOCKS, len(index) - first)
+				msg_blocks = np.array(list(itertools.islice(message, wanted)), dtype=np.uint8).reshape(-1, 64)
+				if (rng is not None):
+					msg_blocks = self.shuffle_blocks(msg_blocks, rng, threshold)
+				slots = np.stack(np.unravel_index(index[first:first + len(msg_blocks)], ordered.shape), axis = 1)
+				strip.embed_blocks(slots, msg_blocks)
+				if (len(msg_blocks) < wanted):
+					done = True
+					break
+		# generator tanpa len, strip yang sudah selesai tidak bisa dikembalikan
+		if (not done and (header is not None or next(message, None) is not None)):
+			raise SteganographyException("Message needs more than the %d blocks of the image" % capacity)
+		if (hasattr(output, 'flush')):
+			output.flush()
+		return output
+
+	def prepare_message(self, message, threshold, counts):
+		"""Resolve threshold = 'auto' from the complexity counts, return
+		(message, threshold, header_threshold). A Message is rebuilt with the
+		threshold the blocks are embedded with, so that its conjugation and
+		header match it. The header always goes in the first plane at least
+		HEADER_THRESHOLD complex, so that show('auto') finds it in every mode
+		"""
+		if (threshold != 'auto'):
+			if (isinstance(message, Message) and message.threshold != threshold):
+				message = Message(message.pathname, threshold = threshold)
+			return message, threshold, HEADER_THRESHOLD
+		if (not isinstance(message, Message)):
+			raise SteganographyException("Automatic threshold needs a Message")
+		threshold = self.select_threshold(len(message), counts = counts)
+		return Message(message.pathname, threshold = threshold), threshold, HEADER_THRESHOLD
+
+	def hide_parallel(self, message, threshold, randomize, key, workers):
+		"""hide with the image in shared memory: the complexity map and then
+		the message blocks are done stripe by stripe in a process pool. Each
+		stripe gets its exact slice of the message from a prefix sum of the
+		usable planes of every block row
+		"""
+		if (not isinstance(message, Message)):
+			raise SteganographyException("Parallel mode needs a Message")
+		seed = self.generate_seed(key) if randomize else None
+		stripes = self.stripes(workers or os.cpu_count())
+		shm, img = share_array(self.img)
+		try:
+			with ProcessPoolExecutor(workers) as pool:
+				shared = (shm.name, img.shape, img.dtype, self.cgc)
+				counts = self.parallel_counts(pool, shared, stripes)
+				message, threshold, header_threshold = self.prepare_message(message, threshold, counts)
+				header_slot, slots = self.embedding_slots(counts / 112, threshold, header_threshold)
+				capacity = 0 if header_slot is None else 1 + len(slots)
+				if (len(message) > capacity):
+					raise SteganographyException("Message needs %d blocks, image only has %d" % (len(message), capacity))
+
+				# header ditulis dulu, stripe yang memuatnya membaca gambar sesudahnya
+				length = message.size()
+				header = message.header_block(length)[0].reshape(1, 64)
+				if (seed is not None):
+					header = self.shuffle_blocks(header, np.random.default_rng(seed), max(threshold, header_threshold))
+				BPCS(img, cgc = self.cgc).embed_blocks(np.array([header_slot]), header)
+
+				tasks = self.stripe_tasks('embed_stripe', shared, counts, stripes, header_slot, slots,
+					Message.blocks_for(length), threshold, message.pathname, seed)
+				list(pool.map(run_stripe, tasks))
+			self.img[:] = img
+		finally:
+			del img
+			shm.close()
+			shm.unlink()
+		return self.img
+
+	def stripes(self, workers):
+		"""(top, bottom) block rows of the stripes of the parallel mode, a few
+		per worker so that uneven stripes even out
+		"""
+		rows = self.row // 8
+		bounds = np.linspace(0, rows, min(rows, 4 * workers) + 1).astype(int)
+		return list(zip(bounds[:-1], bounds[1:]))
+
+	def parallel_counts(self, pool, shared, stripes):
+		"""complexity_counts of the whole image, from the cache or computed
+		stripe by stripe in pool
+		"""
+		# gambar kurang dari 8 baris tidak punya stripe, petanya kosong
+		if (not stripes):
+			return self.cover_counts()
+		key = None if self.cache is None else self.cache.key(self.img, self.cgc)
+		counts = None if key is None else self.cache.get(key)
+		if (counts is None):
+			counts = np.concatenate(list(pool.map(run_stripe, [('stripe_counts', shared, bounds) for bounds in stripes])), axis = 2)
+			if (key is not None):
+				self.cache.put(key, counts)
+		return counts
+
+	def stripe_tasks(self, method, shared, counts, stripes, header_slot, slots, total, threshold, *extra):
+		"""run_stripe tasks of the stripes holding some of the total message
+		blocks, each with its first block and block count
+		"""
+		ordered = counts.transpose(2, 3, 1, 0)
+		header = int(np.ravel_multi_index(header_slot, ordered.shape))
+		# jumlah slot pesan sebelum tiap baris blok
+		before = np.concatenate([[0], np.cumsum(np.bincount(slots[:, 0], minlength = ordered.shape[0]))])
+		tasks = []
+		for top, bottom in stripes:
+			first = min(before[top], total)
+			count = min(before[bottom], total) - first
+			if (count):
+				tasks.append((method, shared, (counts[:, :, top:bottom], top, threshold, header, int(first), int(count)) + extra))
+		return tasks
+
+	def stripe_counts(self, top, bottom):
+		"""complexity_counts of block rows top to bottom
+		"""
+		return self.complexity_counts(self.to_bitplanes(self.img[top * 8:bottom * 8]))
+
+	def stripe_slots(self, counts, top, threshold, header, count):
+		"""The count message slots of a stripe, whose complexity_counts are
+		counts and first block row is top, skipping the header and what is
+		before it. Same order as embedding_slots
+		"""
+		ordered = counts.transpose(2, 3, 1, 0)
+		index = np.flatnonzero(ordered.reshape(-1) / 112 >= threshold)
+		index = index[top * ordered[0].size + index > header][:count]
+		slots = np.stack(np.unravel_index(index, ordered.shape), axis = 1)
+		slots[:, 0] += top
+		return slots
+
+	def stripe_generator(self, seed, first):
+		"""Cell order generator positioned at message block first, as the
+		serial one is after the header and first blocks. Each block draws 63
+		doubles, one 64-bit output each
+		"""
+		rng = np.random.default_rng(seed)
+		rng.bit_generator.advance((1 + first) * BLOCK_BITS)
+		return rng
 
-		msg_bitplane = []
+	def embed_stripe(self, counts, top, threshold, header, first, count, pathname, seed):
+		"""Embed message blocks first to first + count in their stripe
+		"""
+		slots = self.stripe_slots(counts, top, threshold, header, count)
+		msg_blocks = Message(pathname, threshold = threshold).read_blocks(first, first + count)[0].reshape(-1, 64)
+		if (seed is not None):
+			msg_blocks = self.shuffle_blocks(msg_blocks, self.stripe_generator(seed, first), threshold)
+		self.embed_blocks(slots, msg_blocks)
+
+	def extract_stripe(self, counts, top, threshold, header, first, count, seed):
+		"""Message blocks first to first + count of their stripe, packed
+		8 bits per byte along the cells
+		"""
+		blocks = self.extract_blocks(self.stripe_slots(counts, top, threshold, header, count))
+		if (seed is not None):
+			blocks = self.unshuffle_blocks(blocks, self.stripe_generator(seed, first))
+		return np.packbits(blocks, axis = 1)
+
+	def extract_blocks(self, slots):
+		"""Planes at slots, rows of (block_y, block_x, channel, plane), as an
+		(n, 64) uint8 array
+		"""
+		pixels = self.to_code(self.pixel_blocks()[tuple(slots[:, :3].T)])
+		planes = np.unpackbits(pixels[:, np.newaxis], axis = 1)
+		return planes[np.arange(len(slots)), slots[:, 3]].reshape(-1, 64)
+
+	def embed_blocks(self, slots, msg_blocks):
+		"""Put (n, 64) message blocks in the planes at slots, rows of
+		(block_y, block_x, channel, plane) in embedding order. Only the pixel
+		blocks holding a slot are split into planes and only the ones that
+		changed are written back to self.img. Return (index, old values) of
+		those, to undo the write through pixel_blocks()
+		"""
+		pixels = self.pixel_blocks()
+		# slot urut, jadi blok piksel yang sama selalu berdampingan
+		keys = np.ravel_multi_index(tuple(slots[:, :3].T), pixels.shape[:3])
+		keys, inverse = np.unique(keys, return_inverse = True)
+		where = np.unravel_index(keys, pixels.shape[:3])
+		old = pixels[where]
+		planes = np.unpackbits(self.to_code(old)[:, np.newaxis], axis = 1)
+		planes[inverse.reshape(-1), slots[:, 3]] = msg_blocks.reshape(-1, 8, 8)
+		new = self.from_code(np.packbits(planes, axis = 1)[:, 0])
+		changed = np.any(new != old, axis = (1, 2))
+		where = tuple(axis[changed] for axis in where)
+		pixels[where] = new[changed]
+		return where, old[changed]
+
+	def pixel_blocks(self):
+		"""Writable view of the 8x8 pixel blocks of self.img, shape
+		(blocks_y, blocks_x, channels, 8, 8)
+		"""
+		pixels = self.img.reshape(self.row, self.col, -1)
+		rows, cols, channel = pixels.strides
+		return np.lib.stride_tricks.as_strided(pixels, shape = (self.row // 8, self.col // 8, pixels.shape[2], 8, 8),
+			strides = (8 * rows, 8 * cols, channel, rows, cols))
+
+	def show(self, threshold = 0.3, randomize = False, key = None, parallel = False, workers = None, sink = None):
+		"""Return the hidden payload as bytes, or write it to the file-like
+		sink and return its length. Reading stops once the blocks announced
+		by the header block have been read, each strip is decoded as soon as
+		it is read. With threshold = 'auto' the threshold is read from the
+		header block. parallel reads the stripes in workers processes like hide
+		"""
+		if (parallel):
+			return self.show_parallel(threshold, randomize, key, workers, sink)
+		rng = self.key_generator(randomize, key)
+		header_threshold = HEADER_THRESHOLD
+
+		length = None
+		needed = 0
+		got = 0
+		for complexity, blocks in self.iter_strips():
+			start = 0
+			if (length is None):
+				candidates = np.flatnonzero(complexity >= header_threshold)
+				if (not len(candidates)): continue
+				# blok header: panjang payload dan threshold
+				length, recorded = Message.read_header(self.unshuffle_blocks(blocks[candidates[:1]], rng)[0])
+				if (threshold == 'auto'):
+					threshold = recorded
+				needed = Message.blocks_for(length)
+				# panjang dari gambar tanpa pesan bisa sembarang, dicek sebelum buffer dibuat
+				channels = 1 if self.img.ndim == 2 else self.img.shape[2]
+				planes = 8 * channels * (self.row // 8) * (self.col // 8)
+				if (needed > planes):
+					raise SteganographyException("Header announces %d blocks, image only has %d" % (needed, planes))
+				payload = PayloadWriter(length, sink)
+				start = candidates[0] + 1
+			index = start + np.flatnonzero(complexity[start:] >= threshold)
+			index = index[:needed - got]
+			payload.write(self.unshuffle_blocks(blocks[index], rng))
+			got += len(index)
+			if (got >= needed): break
+
+		if (length is None):
+			return PayloadWriter(0, sink).result()
+		if (got < needed):
+			raise SteganographyException("Header announces %d blocks, image only has %d" % (needed, got))
+		return payload.result()
+
+	def show_parallel(self, threshold, randomize, key, workers, sink = None):
+		"""show with the image in shared memory and the stripes read in a
+		process pool, see hide_parallel
+		"""
+		seed = self.generate_seed(key) if randomize else None
+		header_threshold = HEADER_THRESHOLD
+		stripes = self.stripes(workers or os.cpu_count())
+		shm, img = share_array(self.img)
+		try:
+			with ProcessPoolExecutor(workers) as pool:
+				shared = (shm.name, img.shape, img.dtype, self.cgc)
+				counts = self.parallel_counts(pool, shared, stripes)
+				complexity = counts / 112
+				header_slot, _ = self.embedding_slots(complexity, 1, header_threshold)
+				if (header_slot is None): return PayloadWriter(0, sink).result()
+				rng = None if seed is None else np.random.default_rng(seed)
+				length, recorded = Message.read_header(self.unshuffle_blocks(self.extract_blocks(np.array([header_slot])), rng)[0])
+				if (threshold == 'auto'):
+					threshold = recorded
+				header_slot, slots = self.embedding_slots(complexity, threshold, header_threshold)
+				needed = Message.blocks_for(length)
+				if (needed > len(slots)):
+					raise SteganographyException("Header announces %d blocks, image only has %d" % (needed, len(slots)))
+				tasks = self.stripe_tasks('extract_stripe', shared, counts, stripes,
+					header_slot, slots, needed, threshold, seed)
+				# stripe ditulis berurutan begitu selesai
+				payload = PayloadWriter(length, sink)
+				for packed in pool.map(run_stripe, tasks):
+					payload.write(np.unpackbits(packed, axis = 1))
+		finally:
+			del img
+			shm.close()
+			shm.unlink()
+		return payload.result()
+
+	def iter_strips(self, strip_rows = 8):
+		"""Yield (complexity, blocks) for strip_rows rows of blocks at a
+		time, both flattened in embedding order: complexity of each plane and
+		the plane itself as a (n, 64) uint8 array
+		"""
+		# peta dari cache kalau ada, tapi tidak dihitung penuh supaya tetap bisa berhenti cepat
+		cached = self.cached_complexity()
+		for top in range(0, self.row // 8 * 8, strip_rows * 8):
+			bitplanes = self.to_bitplanes(self.img[top:top + strip_rows * 8])
+			if (cached is not None):
+				complexity = cached[:, :, top // 8:top // 8 + strip_rows]
+			else:
+				complexity = self.complexity_map(bitplanes)
+			yield complexity.transpose(2, 3, 1, 0).reshape(-1), self.to_blocks(bitplanes).reshape(-1, 64)
+
+	def embedding_slots(self, complexity, threshold, header_threshold):
+		"""Slots of the header block and of the message blocks as
+		(block_y, block_x, channel, plane): the header takes the first plane
+		at least header_threshold complex, the message the planes after it
+		at least threshold complex. Header slot is None if there is none
+		"""
+		ordered = complexity.transpose(2, 3, 1, 0)
+		flat = ordered.reshape(-1)
+		candidates = np.flatnonzero(flat >= header_threshold)
+		if (not len(candidates)):
+			return None, np.zeros((0, 4), np.intp)
+		header = candidates[0]
+		index = header + 1 + np.flatnonzero(flat[header + 1:] >= threshold)
+		return np.unravel_index(header, ordered.shape), np.stack(np.unravel_index(index, ordered.shape), axis = 1)
+
+	def select_threshold(self, nb_blocks, complexity = None, counts = None):
+		"""Highest threshold (at most 0.5, so conjugation still works) for
+		which nb_blocks message blocks fit, header included. Binary search on
+		the cumulative histogram of the plane complexities
+		"""
+		if (counts is None):
+			counts = self.cover_counts() if complexity is None else np.rint(complexity * 112).astype(np.uint8)
+		histogram = self.counts_histogram(counts, HEADER_THRESHOLD)
+		if (histogram is None):
+			raise SteganographyException("Image has no block complex enough")
+		# fits[c] = jumlah bitplane dengan border change >= c, tidak naik
+		fits = histogram[::-1].cumsum()[::-1][:57]
+		best = int(np.searchsorted(-fits, -(nb_blocks - 1), side = 'right')) - 1
+		if (best < 0):
+			raise SteganographyException("Message needs %d blocks, image only has %d" % (nb_blocks, 1 + fits[0]))
+		return best / 112
+
+	def counts_histogram(self, counts, header_threshold, strip_rows = 8):
+		"""Histogram of the complexity counts (0 to 112) of the planes after
+		the header block, the first one at least header_threshold complex.
+		None if there is no such plane
+		"""
+		histogram = None
+		for top in range(0, counts.shape[2], strip_rows):
+			flat = counts[:, :, top:top + strip_rows].transpose(2, 3, 1, 0).reshape(-1)
+			start = 0
+			if (histogram is None):
+				candidates = np.flatnonzero(flat / 112 >= header_threshold)
+				if (not len(candidates)): continue
+				histogram = np.zeros(113, np.intp)
+				start = candidates[0] + 1
+			histogram += np.bincount(flat[start:], minlength = 113)
+		return histogram
+
+	def capacity(self, threshold = 0.3):
+		"""Number of message blocks the image can hold, header included.
+		Only the complexity counts are held, like in hide_tiled
+		"""
+		return self.counts_capacity(self.cover_counts(), threshold)
 
-		if (randomize):
-			random.seed(self.generate_seed(key))
+	def counts_capacity(self, counts, threshold, strip_rows = 8):
+		"""capacity from complexity_counts: the header plane and the planes
+		after it at least threshold complex
+		"""
+		histogram = self.counts_histogram(counts, HEADER_THRESHOLD, strip_rows)
+		return 0 if histogram is None else 1 + int(histogram[np.arange(113) / 112 >= threshold].sum())
 
-		msg_iterator = 0
-		for row in range(0,self.row - windowsize_r + 1, windowsize_r):
-			for col in range(0,self.col - windowsize_c + 1, windowsize_c):
-				temp_block = self.img[row:row+windowsize_r, col:col+windowsize_c]
-				channels_block = cv2.split(temp_block)
+	def capacity_bytes(self, threshold = 0.3):
+		"""Payload bytes the image can hold
+		"""
+		return max(0, self.capacity(threshold) - 1) * BLOCK_BITS // 8
 
-				channels_bitplane = [self.to_bitplane(block) for block in channels_block]
+	def cover_counts(self, strip_rows = 8):
+		"""complexity_counts of the whole current image, from the cache or
+		computed strip_rows rows of blocks at a time so that only a strip is
+		ever split into bit planes
+		"""
+		key = None if self.cache is None else self.cache.key(self.img, self.cgc)
+		counts = None if key is None else self.cache.get(key)
+		if (counts is None):
+			rows = self.row // 8
+			channels = 1 if self.img.ndim == 2 else self.img.shape[2]
+			counts = np.empty((8, channels, rows, self.col // 8), np.uint8)
+			for top in range(0, rows, strip_rows):
+				counts[:, :, top:top + strip_rows] = self.stripe_counts(top, min(top + strip_rows, rows))
+			if (key is not None):
+				self.cache.put(key, counts)
+		return counts
+
+	def cached_complexity(self):
+		"""Complexity map of the current image from the cache, or None
+		"""
+		if (self.cache is None):
+			return None
+		counts = self.cache.get(self.cache.key(self.img, self.cgc))
+		return None if counts is None else counts / 112
+
+	def unshuffle_blocks(self, blocks, rng):
+		"""Undo shuffle_blocks on (n, 64) blocks, like get_msg_randomly.
+		Nothing to do when rng is None
+		"""
+		if (rng is None):
+			return blocks
+		blocks = blocks.copy()
+		blocks[blocks[:, 0] == 1] ^= WC.reshape(64)
+		return np.take_along_axis(blocks, self.block_permutations(rng, len(blocks)), axis=1)
+
+	def to_code(self, img):
+		"""Pixel values in the code the planes are taken from: Canonical
+		Gray Code in cgc mode, pure binary otherwise
+		"""
+		return img ^ (img >> 1) if self.cgc else img
 
-				i = 0
-				for channel_bitplane in channels_bitplane:
-					j = 0
-					for bitplane in channel_bitplane:
-						if(self.calculate_complexity(bitplane) >= threshold):
-							if (randomize):
-								rand_sequence = random.sample(range(64),64)
-								msg_bitplane.append(self.get_msg_randomly(bitplane, rand_sequence))
-							else:
-								msg_bitplane.append(bitplane)
-							msg_iterator += 1
-							if (msg_iterator < 5):
-								print("get at", row, col, i, j)
-						j += 1
-					i += 1
+	def from_code(self, img):
+		"""Inverse of to_code
+		"""
+		if (not self.cgc):
+			return img
+		img = img ^ (img >> 4)
+		img ^= img >> 2
+		img ^= img >> 1
+		return img
+
+	def to_bitplanes(self, img):
+		"""Split the whole image into bit planes, uint8 array of shape
+		(8, channels, rows, cols), most significant plane first
+		"""
+		channels = self.to_code(img).reshape(img.shape[0], img.shape[1], -1).transpose(2, 0, 1)
+		return np.unpackbits(channels[np.newaxis], axis=0)
 
+	def to_blocks(self, bitplanes):
+		"""View of the 8x8 blocks of to_bitplanes output, shape
+		(blocks_y, blocks_x, channels, 8, 8, 8), writes go to bitplanes
+		"""
+		planes, channels, rows, cols = bitplanes.shape
+		blocks = bitplanes[:, :, :rows // 8 * 8, :cols // 8 * 8].view()
+		blocks.shape = (planes, channels, rows // 8, 8, cols // 8, 8)
+		return blocks.transpose(2, 4, 1, 0, 3, 5)
+
+	def complexity_map(self, bitplanes):
+		"""Border changes of every 8x8 block of every bit plane divided by
+		112, shape (planes, channels, blocks_y, blocks_x)
+		"""
+		return self.complexity_counts(bitplanes) / 112
 
-		return msg_bitplane
+	def complexity_counts(self, bitplanes):
+		"""Border changes of every 8x8 block of every bit plane, 0 to 112 as
+		uint8, shape (planes, channels, blocks_y, blocks_x)
+		"""
+		planes, channels, rows, cols = bitplanes.shape
+		blocks = bitplanes[:, :, :rows // 8 * 8, :cols // 8 * 8].reshape(planes, channels, rows // 8, 8, cols // 8, 8)
+		counter = np.count_nonzero(blocks[:, :, :, 1:] ^ blocks[:, :, :, :-1], axis=(3, 5))
+		counter += np.count_nonzero(blocks[..., 1:] ^ blocks[..., :-1], axis=(3, 5))
+		return counter.astype(np.uint8)
 
 	def to_bitplane(self, img):
 		result = []
@@ -142,17 +748,27 @@ class BPCS(object):
 					+ bitplane[5]) + bitplane[6]) + bitplane[7])
 		return result
 
-	def calculate_complexity(self, img):
-		counter = 0
-		for r in range(img.shape[0]):
-			for c in range(img.shape[1]):
-				if(r != img.shape[0]-1):
-					if(img[r][c] != img[r+1][c]):
-						counter += 1
-				if(c != img.shape[1]-1):
-					if(img[r][c] != img[r][c+1]):
-						counter += 1
-		return counter / 112
+def share_array(array):
+	"""Copy array in a new shared memory block, return (shm, view)
+	"""
+	shm = shared_memory.SharedMemory(create = True, size = max(1, array.nbytes))
+	view = np.ndarray(array.shape, array.dtype, shm.buf)
+	view[:] = array
+	return shm, view
+
+def run_stripe(task):
+	"""Worker of the parallel mode: task is (method, (name, shape, dtype,
+	cgc) of the shared image, args), run method(*args) of a BPCS on that image
+	"""
+	method, (name, shape, dtype, cgc), args = task
+	shm = shared_memory.SharedMemory(name = name)
+	steg = BPCS(np.ndarray(shape, dtype, shm.buf), cgc = cgc)
+	try:
+		return getattr(steg, method)(*args)
+	finally:
+		# view dilepas dulu, kalau tidak close gagal
+		del steg
+		shm.close()
 
 if __name__ == '__main__':
 	bpcs = BPCS('testcase/original_img/Ape_Face_grayscale.png')
@@ -15,8 +15,8 @@ def process_file(input_path, output_path, filename):
     try:
         bpcs = BPCS(input_path)
         msg = Message(pathname='secret.txt')
-        bitplane_msg = msg.create_message()
-        img_result = bpcs.hide(bitplane_msg)
+        # kapasitas dicek dulu, gambar yang kekecilan langsung ditolak
+        img_result = bpcs.hide(msg)
 
         cv2.imwrite(output_path, img_result)
         print(f"✅ Disimpan ke: {output_path}")
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+import math
+import numpy as np
+
+# papan catur untuk konjugasi, sel [0,0] bernilai 1 jadi sekalian penanda
+WC = (np.indices((8, 8)).sum(axis=0) % 2 ^ 1).astype(np.uint8)
+BLOCK_BITS = 63 # bit [0,0] tiap blok dipakai penanda konjugasi
+CHUNK_BLOCKS = 4096 # blok yang dibuat sekaligus dari file
+LENGTH_BITS = 48 # panjang payload (byte) di blok header
+THRESHOLD_BITS = 7 # threshold x 112 di blok header, setelah panjang payload
+HEADER_THRESHOLD = 0.3 # threshold blok header, threshold payload apa pun
+
+def block_complexity(blocks):
+	"""Complexity of a stack of 8x8 binary blocks, shape (n, 8, 8)
+	"""
+	counter = np.count_nonzero(blocks[:, 1:] ^ blocks[:, :-1], axis=(1, 2))
+	counter += np.count_nonzero(blocks[:, :, 1:] ^ blocks[:, :, :-1], axis=(1, 2))
+	return counter / 112
+
+class Message(object):
+
+	def __init__(self, pathname, threshold = 0.3):
+		"""threshold must not be above 0.5, a conjugated block has
+		complexity 1 - a for a block of complexity a
+		"""
+		self.pathname = pathname
+		self.threshold = threshold
+		self.conjugation_map = None
+
+	def __len__(self):
+		"""Number of blocks create_message yields, header included
+		"""
+		return 1 + self.blocks_for(self.size())
+
+	def __iter__(self):
+		return self.create_message()
+
+	def size(self):
+		"""Payload size in bytes
+		"""
+		with open(self.pathname, 'rb') as f:
+			f.seek(0, 2)
+			return f.tell()
+
+	@staticmethod
+	def blocks_for(length):
+		"""Number of data blocks holding length bytes
+		"""
+		return -(-length * 8 // BLOCK_BITS)
+
+	def create_message(self):
+		"""Yield the message blocks lazily, 8x8 uint8 arrays, reading the
+		file CHUNK_BLOCKS blocks at a time. Blocks less complex than the
+		threshold are conjugated and flagged in cell [0,0]. Once the
+		generator is exhausted conjugation_map holds one packed bit per block.
+		The first block is a header holding the payload length
+		"""
+		header, conj = self.header_block(self.size())
+		conjugated = [conj]
+		yield header
+		with open(self.pathname, 'rb') as f:
+			while True:
+				# kelipatan 63 byte supaya pas jadi blok utuh
+				data = f.read(CHUNK_BLOCKS * BLOCK_BITS // 8)
+				if not data:
+					break
+				blocks, conj = self.to_blocks(data)
+				conjugated.append(conj)
+				for block in blocks:
+					yield block
+		self.conjugation_map = np.packbits(np.concatenate(conjugated)) if conjugated else np.zeros(0, np.uint8)
+
+	def read_blocks(self, start, stop):
+		"""Data blocks start to stop (header not counted) as create_message
+		yields them, reading only the bytes they hold. Return (blocks, conjugated)
+		"""
+		first = start * BLOCK_BITS // 8
+		with open(self.pathname, 'rb') as f:
+			f.seek(first)
+			data = f.read(-(-stop * BLOCK_BITS // 8) - first)
+		bits = np.unpackbits(np.frombuffer(data, np.uint8))
+		offset = start * BLOCK_BITS - first * 8
+		return self.bits_to_blocks(bits[offset:offset + (stop - start) * BLOCK_BITS])
+
+	def to_blocks(self, data):
+		"""Turn bytes into conjugated 8x8 blocks, return (blocks, conjugated)
+		"""
+		return self.bits_to_blocks(np.unpackbits(np.frombuffer(data, np.uint8)))
+
+	def bits_to_blocks(self, bits):
+		"""Turn a bit array into conjugated 8x8 blocks, return (blocks, conjugated)
+		"""
+		bits = np.concatenate([bits, np.zeros(-len(bits) % BLOCK_BITS, np.uint8)])
+		blocks = np.zeros((len(bits) // BLOCK_BITS, 64), np.uint8)
+		blocks[:, 1:] = bits.reshape(-1, BLOCK_BITS)
+		blocks = blocks.reshape(-1, 8, 8)
+		conj = block_complexity(blocks) < self.threshold
+		blocks[conj] ^= WC
+		return blocks, conj
+
+	@staticmethod
+	def threshold_count(threshold):
+		"""Smallest number of border changes reaching threshold
+		"""
+		return int(math.ceil(round(threshold * 112, 6)))
+
+	def header_block(self, length):
+		"""Header block: payload length on LENGTH_BITS bits then the
+		threshold as a count of border changes on THRESHOLD_BITS bits. It is
+		conjugated so that it passes both the threshold and HEADER_THRESHOLD.
+		Return (block, conjugated)
+		"""
+		fields = (length << THRESHOLD_BITS) | self.threshold_count(self.threshold)
+		bits = np.unpackbits(np.frombuffer(fields.to_bytes(8, 'big'), np.uint8))[64 - LENGTH_BITS - THRESHOLD_BITS:]
+		blocks = np.zeros((1, 64), np.uint8)
+		blocks[0, 1:1 + LENGTH_BITS + THRESHOLD_BITS] = bits
+		blocks = blocks.reshape(-1, 8, 8)
+		conj = block_complexity(blocks) < max(self.threshold, HEADER_THRESHOLD)
+		blocks[conj] ^= WC
+		return blocks[0], conj
+
+	@staticmethod
+	def read_header(block):
+		"""(payload length, threshold) stored in an extracted header block
+		"""
+		block = np.array(block, dtype=np.uint8).reshape(8, 8)
+		if block[0, 0] == 1:
+			block ^= WC
+		bits = block.reshape(64)[1:1 + LENGTH_BITS + THRESHOLD_BITS]
+		fields = int.from_bytes(np.packbits(np.concatenate([np.zeros(64 - len(bits), np.uint8), bits])).tobytes(), 'big')
+		return fields >> THRESHOLD_BITS, (fields & (2 ** THRESHOLD_BITS - 1)) / 112
+
+	@staticmethod
+	def decode_bits(blocks):
+		"""Undo the conjugation of extracted blocks, all at once, and return
+		their data bits
+		"""
+		blocks = np.array(blocks, dtype=np.uint8).reshape(-1, 64)
+		blocks[blocks[:, 0] == 1] ^= WC.reshape(64)
+		return blocks[:, 1:].reshape(-1)
+
+class PayloadWriter(object):
+	"""Turn extracted data blocks into the payload bytes as they come, into
+	a preallocated buffer or into a file-like sink, keeping only the bits of
+	the last incomplete byte in between
+	"""
+
+	def __init__(self, length, sink = None):
+		self.length = length
+		self.sink = sink
+		self.output = None if sink is not None else bytearray(length)
+		self.written = 0
+		self.carry = np.zeros(0, np.uint8)
+
+	def write(self, blocks):
+		"""Add the next (n, 64) data blocks, the padding after length is dropped
+		"""
+		bits = np.concatenate([self.carry, Message.decode_bits(blocks)])
+		count = min(len(bits) // 8, self.length - self.written)
+		chunk = np.packbits(bits[:count * 8]).tobytes()
+		self.carry = bits[count * 8:]
+		if (self.sink is not None):
+			self.sink.write(chunk)
+		else:
+			self.output[self.written:self.written + count] = chunk
+		self.written += count
+
+	def result(self):
+		"""The payload as bytes, or its length when written to a sink
+		"""
+		return self.length if self.sink is not None else bytes(self.output)
@@ -3,8 +3,8 @@
 """LSBSteg.py
 
 Usage:
-  LSBSteg.py encode -i <input> -o <output> -f <file>
-  LSBSteg.py decode -i <input> -o <output>
+  LSBSteg.py encode -i <input> -o <output> -f <file> [-k <key>] [-m]
+  LSBSteg.py decode -i <input> -o <output> [-k <key>]
 
 Options:
   -h, --help                Show this help
@@ -12,23 +12,277 @@ Options:
   -f,--file=<file>          File to hide
   -i,--in=<input>           Input image (carrier)
   -o,--out=<output>         Output image (or extracted file)
+  -k,--key=<key>            Key used to shuffle the pixel order
+  -m,--matching             LSB matching (+-1) instead of LSB replacement
 """
 
 import cv2
 import docopt
+import functools
+import hashlib
 import numpy as np
 import os
+import shutil
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+
+CHUNKSIZE = 1 << 20 #Bytes decoded per step when streaming a payload out of the carrier
+MMAP_FORMATS = ["bmp", "npy"] #Carriers encoded in place through open_carrier
+SHARD_HEADER = struct.Struct(">HHQ") #Shard index, number of shards, shard length in bytes
 
 
 class SteganographyException(Exception):
     pass
 
 
+def open_carrier(path, mode="r+", shape=None):
+    #Map an uncompressed carrier file in memory instead of decoding it, so
+    #only the pages holding payload bits are read or written. Supports .npy
+    #arrays, 24 bits BMP and raw interleaved uint8 dumps (shape required)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npy":
+        im = np.load(path, mmap_mode=mode)
+        if im.dtype != np.uint8:
+            raise SteganographyException("Only uint8 arrays can be used as carrier")
+        return im if im.ndim == 3 else im.reshape(im.shape[0], im.shape[1], 1)
+    if ext == ".bmp":
+        header = np.fromfile(path, np.uint8, 54)
+        offset = int(header[10:14].view("<u4")[0])
+        width, height = (int(v) for v in header[18:26].view("<i4"))
+        bitcount, compression = int(header[28:30].view("<u2")[0]), int(header[30:34].view("<u4")[0])
+        if bitcount != 24 or compression != 0:
+            raise SteganographyException("Only uncompressed 24 bits BMP can be memory mapped")
+        stride = (width * 3 + 3) // 4 * 4 #Rows are padded to 4 bytes
+        mm = np.memmap(path, np.uint8, mode, offset, (abs(height), stride))
+        im = mm[:, :width*3].reshape(abs(height), width, 3)
+        return im[::-1] if height > 0 else im #Bottom-up rows, flipped to match cv2.imread
+    if shape is None:
+        raise SteganographyException("Raw carriers need an explicit (height, width, channels) shape")
+    return np.memmap(path, np.uint8, mode, shape=tuple(shape))
+
+
+@functools.lru_cache(maxsize=1)
+def slot_permutation(key, shape):
+    #Keyed order in which the slots of one bit plane are used, generated in
+    #one step and cached so consecutive same-size carriers share it. Read-only
+    seed = int.from_bytes(hashlib.sha256(key.encode("utf-8") if isinstance(key, str) else key).digest(), "big")
+    n = int(np.prod(shape))
+    perm = np.arange(n, dtype=np.uint32 if n < 1 << 32 else np.uint64) #Shuffled in place, same order as permutation(n)
+    np.random.default_rng(seed).shuffle(perm)
+    perm.flags.writeable = False
+    return perm
+
+
+class PreparedPayload():
+    #Header and payload bits computed once, then embedded read-only into any
+    #number of carriers. Can be placed in shared memory for worker processes:
+    #    with payload.share() as shared: #Block unlinked on exit
+    #        pool.map(work, [(shared.name, len(shared))] * n)
+    #and in every worker:
+    #    with PreparedPayload.attach(name, nbits) as payload: #Closed on exit
+    #        embed_prepared(im, payload)
+    def __init__(self, bits, shm=None, owner=False):
+        self.bits = np.ascontiguousarray(bits, np.uint8) #uint8 0/1, header included
+        self.bits.flags.writeable = False
+        self.shm = shm #SharedMemory block backing bits, if any
+        self.owner = owner #Created by share(), so unlinked on exit
+
+    @classmethod
+    def from_binary(cls, data): #Same layout as LSBSteg.encode_binary
+        if isinstance(data, str): # Compat py2/py3
+            data = data.encode("latin-1")
+        return cls(np.unpackbits(np.frombuffer(len(data).to_bytes(8, "big") + bytes(data), np.uint8)))
+
+    @classmethod
+    def from_text(cls, txt): #Same layout as LSBSteg.encode_text
+        data = txt.encode("utf-8")
+        if len(data) >= 1 << 32:
+            raise SteganographyException("binary value larger than the expected size")
+        return cls(np.unpackbits(np.frombuffer(len(data).to_bytes(4, "big") + data, np.uint8)))
+
+    def __len__(self):
+        return len(self.bits)
+
+    def share(self): #Copy the bits in a new shared memory block, to attach() from other processes
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(self.bits)))
+        np.ndarray(len(self.bits), np.uint8, shm.buf)[:] = self.bits
+        return PreparedPayload(np.ndarray(len(self.bits), np.uint8, shm.buf), shm, owner=True)
+
+    @classmethod
+    def attach(cls, name, nbits): #Payload already shared by share(), without copying it
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(np.ndarray(nbits, np.uint8, shm.buf), shm)
+
+    @property
+    def name(self): #Name of the shared memory block to attach(), None when not shared
+        return None if self.shm is None else self.shm.name
+
+    def close(self): #Detach this process from the shared memory block, bits can no longer be used
+        if self.shm is not None:
+            self.bits = None #Drop the view first, the buffer cannot be closed while exported
+            self.shm.close()
+
+    def unlink(self): #Free the shared memory block once every process has closed it
+        if self.shm is not None:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.owner:
+            self.unlink()
+        self.close()
+
+
+def rows_view(im): #Return im as (height, width*nbchannels) without copying it
+    rows = im.view()
+    try:
+        rows.shape = (im.shape[0], im.shape[1] * im.shape[2])
+    except AttributeError: #Channels not contiguous, only possible for in-memory arrays
+        raise SteganographyException("Carrier channels must be contiguous in memory")
+    return rows
+
+
+def matching_delta(vals, bits, plane, rng): #Return what to add (mod 256) to vals so the plane bit equals bits
+    step = 1 << plane
+    change = ((vals >> np.uint8(plane)) & 1) != bits
+    up = rng.integers(0, 2, vals.shape, dtype=np.uint8).astype(bool) #Random sign
+    up |= vals < step #Saturation at 0, can only add
+    up &= vals <= 255 - step #Saturation at 255, can only subtract
+    return np.where(change, np.where(up, np.uint8(step), np.uint8(256 - step)), np.uint8(0))
+
+
+class Carrier():
+    #Slot layout of a carrier: the views the bulk engine works on and the
+    #keyed slot order. There is no cursor, every call is given its start
+    #slot, so one Carrier can be shared between threads
+    def __init__(self, im, key=None):
+        self.image = im
+        self.height, self.width, self.nbchannels = im.shape
+        self.planesize = self.height * self.width * self.nbchannels # Number of slots in one bit plane
+        self.rows = rows_view(im) # (height, width*nbchannels) view, written in place
+        self.permutation = None if key is None else slot_permutation(key, im.shape) # Raster order without key
+        self.slots = self.rows.reshape(-1) if self.rows.flags.c_contiguous else self.rows # Indexed by keyed_segments
+
+    def check_slots(self, start, nb, planes=8): #Return the slot following nb slots from start, like next_slot would
+        end = start + nb
+        if end >= planes * self.planesize:
+            raise SteganographyException("No available slot remaining (image filled)")
+        return end
+
+    def write_bits(self, start, bits, matching=False, rng=None): #Put an array of bits (uint8 0/1) from slot start, one pass per bit plane
+        end = self.check_slots(start, len(bits))
+        bits = np.asarray(bits, np.uint8)
+        if self.permutation is not None:
+            for plane, index, offset, count in self.keyed_segments(start, len(bits)):
+                chunk = self.slots[index]
+                if matching:
+                    chunk += matching_delta(chunk, bits[offset:offset+count], plane, rng)
+                else:
+                    chunk &= np.uint8(255 ^ (1 << plane))
+                    chunk |= bits[offset:offset+count] << np.uint8(plane)
+                self.slots[index] = chunk
+        else:
+            for plane, chunk, offset in self.slot_segments(start, len(bits)):
+                payload = bits[offset:offset+chunk.size].reshape(chunk.shape)
+                if matching:
+                    chunk += matching_delta(chunk, payload, plane, rng)
+                else:
+                    np.bitwise_and(chunk, np.uint8(255 ^ (1 << plane)), out=chunk) #AND with maskZERO
+                    np.bitwise_or(chunk, payload << np.uint8(plane), out=chunk) #OR with the bits moved to maskONE
+        return end
+
+    def read_bits(self, start, nb): #Read nb bits from slot start as an array of uint8 0/1
+        self.check_slots(start, nb)
+        bits = np.empty(nb, np.uint8)
+        if self.permutation is not None:
+            for plane, index, offset, count in self.keyed_segments(start, nb):
+                np.right_shift(self.slots[index], plane, out=bits[offset:offset+count])
+        else:
+            for plane, chunk, offset in self.slot_segments(start, nb):
+                np.right_shift(chunk, plane, out=bits[offset:offset+chunk.size].reshape(chunk.shape))
+        bits &= 1
+        return bits
+
+    def read_bytes(self, start, nb, sink=None, chunksize=CHUNKSIZE):
+        #Read nb bytes from slot start, chunksize bytes at a time. Without sink
+        #they are returned as bytes, otherwise written to the file-like sink
+        #and nb is returned
+        self.check_slots(start, 8 * nb) #A bad length fails here, before anything is allocated
+        output = None if sink is not None else bytearray(nb) #Preallocated, filled in place
+        for offset in range(0, nb, chunksize):
+            count = min(chunksize, nb - offset)
+            chunk = np.packbits(self.read_bits(start + 8 * offset, 8 * count)).tobytes()
+            if sink is not None:
+                sink.write(chunk)
+            else:
+                output[offset:offset+count] = chunk
+        return nb if sink is not None else bytes(output)
+
+    def write_values(self, start, values, k): #Put an array of k bits values (uint8) in the k lowest bits of the slots of the first plane
+        end = self.check_slots(start, len(values), 1)
+        mask = np.uint8(255 ^ ((1 << k) - 1))
+        if self.permutation is not None:
+            for plane, index, offset, count in self.keyed_segments(start, len(values)):
+                self.slots[index] = (self.slots[index] & mask) | values[offset:offset+count]
+        else:
+            for plane, chunk, offset in self.slot_segments(start, len(values)):
+                np.bitwise_and(chunk, mask, out=chunk)
+                np.bitwise_or(chunk, values[offset:offset+chunk.size].reshape(chunk.shape), out=chunk)
+        return end
+
+    def read_values(self, start, nb, k): #Read the k lowest bits of nb slots of the first plane
+        self.check_slots(start, nb, 1)
+        values = np.empty(nb, np.uint8)
+        if self.permutation is not None:
+            for plane, index, offset, count in self.keyed_segments(start, nb):
+                values[offset:offset+count] = self.slots[index]
+        else:
+            for plane, chunk, offset in self.slot_segments(start, nb):
+                values[offset:offset+chunk.size].reshape(chunk.shape)[...] = chunk
+        values &= np.uint8((1 << k) - 1)
+        return values
+
+    def keyed_segments(self, start, nb): #Yield (plane, index in self.slots, offset, count) covering nb slots from start in keyed order
+        done = 0
+        while done < nb:
+            plane, pos = divmod(start + done, self.planesize)
+            count = min(nb - done, self.planesize - pos)
+            index = self.permutation[pos:pos+count]
+            if self.slots.ndim == 2: #Strided carrier, index the rows
+                index = np.divmod(index, self.rows.shape[1])
+            yield plane, index, done, count
+            done += count
+
+    def slot_segments(self, start, nb): #Yield (plane, view, offset) blocks of rows covering nb slots from start
+        rowlen = self.width * self.nbchannels
+        done = 0
+        while done < nb:
+            plane, pos = divmod(start + done, self.planesize)
+            row, col = divmod(pos, rowlen)
+            count = min(nb - done, self.planesize - pos)
+            if col == 0 and count >= rowlen: #As many whole rows as possible in one view
+                nbrows = count // rowlen
+                chunk = self.rows[row:row+nbrows]
+            else: #Or the end of the current row
+                chunk = self.rows[row:row+1, col:col+min(count, rowlen - col)]
+            yield plane, chunk, done
+            done += chunk.size
+
+
 class LSBSteg():
-    def __init__(self, im):
+    def __init__(self, im, key=None, matching=False):
+        self.carrier = Carrier(im, key)
         self.image = im
         self.height, self.width, self.nbchannels = im.shape
         self.size = self.width * self.height
+        self.planesize = self.carrier.planesize # Number of slots in one bit plane
+        self.permutation = self.carrier.permutation # Raster order without key
+        self.matching = matching # Add or subtract instead of overwriting the bit, same decoder
+        self.rng = np.random.default_rng() # Signs of the matching changes
         
         self.maskONEValues = [1,2,4,8,16,32,64,128]
         #Mask used to put one ex:1->00000001, 2->00000010 .. associated with OR bitwise
@@ -43,16 +297,24 @@ class LSBSteg():
         self.curchan = 0   # Current channel position
 
     def put_binary_value(self, bits): #Put the bits in the image
-        for c in bits:
-            val = list(self.image[self.curheight,self.curwidth]) #Get the pixel value as a list
-            if int(c) == 1:
-                val[self.curchan] = int(val[self.curchan]) | self.maskONE #OR with maskONE
-            else:
-                val[self.curchan] = int(val[self.curchan]) & self.maskZERO #AND with maskZERO
-                
-            self.image[self.curheight,self.curwidth] = tuple(val)
-            self.next_slot() #Move "cursor" to the next space
-        
+        self.put_bits(np.frombuffer(bits.encode("ascii"), np.uint8) - ord("0"))
+
+    def put_bits(self, bits): #Put an array of bits (uint8 0/1) in the image in one pass per bit plane
+        self.seek(self.carrier.write_bits(self.tell(), bits, self.matching, self.rng))
+
+    def tell(self): #Return the current slot index, counting across bit planes
+        plane = 7 - len(self.maskONEValues)
+        return plane * self.planesize + (self.curheight * self.width + self.curwidth) * self.nbchannels + self.curchan
+
+    def seek(self, slot): #Move the "cursor" to the given slot index
+        plane, pos = divmod(slot, self.planesize)
+        self.curheight, pos = divmod(pos, self.width * self.nbchannels)
+        self.curwidth, self.curchan = divmod(pos, self.nbchannels)
+        self.maskONE = 1 << plane
+        self.maskZERO = 255 ^ self.maskONE
+        self.maskONEValues = [1 << p for p in range(plane + 1, 8)]
+        self.maskZEROValues = [255 ^ m for m in self.maskONEValues]
+
     def next_slot(self):#Move to the next slot were information can be taken or put
         if self.curchan == self.nbchannels-1: #Next Space is the following channel
             self.curchan = 0
@@ -73,10 +335,7 @@ class LSBSteg():
             self.curchan +=1
 
     def read_bit(self): #Read a single bit int the image
-        val = self.image[self.curheight,self.curwidth][self.curchan]
-        val = int(val) & self.maskONE
-        self.next_slot()
-        if val > 0:
+        if self.read_bit_array(1)[0] > 0:
             return "1"
         else:
             return "0"
@@ -85,11 +344,29 @@ class LSBSteg():
         return self.read_bits(8)
     
     def read_bits(self, nb): #Read the given number of bits
-        bits = ""
-        for i in range(nb):
-            bits += self.read_bit()
+        return (self.read_bit_array(nb) + ord("0")).tobytes().decode("ascii")
+
+    def put_values(self, values, k): #Put an array of k bits values (uint8) in the k lowest bits of the next slots of the first plane
+        self.seek(self.carrier.write_values(self.tell(), values, k))
+
+    def read_values(self, nb, k): #Read the k lowest bits of the next nb slots of the first plane
+        start = self.tell()
+        values = self.carrier.read_values(start, nb, k)
+        self.seek(start + nb)
+        return values
+
+    def read_bit_array(self, nb): #Read the given number of bits as an array of uint8 0/1
+        start = self.tell()
+        bits = self.carrier.read_bits(start, nb)
+        self.seek(start + nb)
         return bits
 
+    def read_payload(self, nb, sink=None, chunksize=CHUNKSIZE): #Read the next nb bytes, see Carrier.read_bytes
+        start = self.tell()
+        output = self.carrier.read_bytes(start, nb, sink, chunksize)
+        self.seek(start + 8 * nb)
+        return output
+
     def byteValue(self, val):
         return self.binary_value(val, 8)
         
@@ -102,78 +379,210 @@ class LSBSteg():
         return binval
 
     def encode_text(self, txt):
-        l = len(txt)
-        binl = self.binary_value(l, 16) #Length coded on 2 bytes so the text size can be up to 65536 bytes long
-        self.put_binary_value(binl) #Put text length coded on 4 bytes
-        for char in txt: #And put all the chars
-            c = ord(char)
-            self.put_binary_value(self.byteValue(c))
-        return self.image
+        return self.encode_prepared(PreparedPayload.from_text(txt)) #Length on 4 bytes then the UTF-8 bytes
        
     def decode_text(self):
-        ls = self.read_bits(16) #Read the text size in bytes
+        ls = self.read_bits(32) #Read the text size in bytes
         l = int(ls,2)
-        i = 0
-        unhideTxt = ""
-        while i < l: #Read all bytes of the text
-            tmp = self.read_byte() #So one byte
-            i += 1
-            unhideTxt += chr(int(tmp,2)) #Every chars concatenated to str
-        return unhideTxt
-
-    def encode_image(self, imtohide):
-        w = imtohide.width
-        h = imtohide.height
-        if self.width*self.height*self.nbchannels < w*h*imtohide.channels:
-            raise SteganographyException("Carrier image not big enough to hold all the datas to steganography")
+        return self.read_payload(l).decode("utf-8") #Read all bytes of the text
+
+    def encode_image(self, imtohide): #Hide a uint8 image (h,w) or (h,w,channels)
+        if imtohide.dtype != np.uint8:
+            raise SteganographyException("Only 8 bits images can be hidden")
+        if imtohide.ndim == 2: #Grayscale, one channel
+            imtohide = imtohide[:, :, np.newaxis]
+        h, w, channels = imtohide.shape
+        self.carrier.check_slots(self.tell(), 40 + 8*w*h*channels) #Header and pixels checked before anything is written
         binw = self.binary_value(w, 16) #Width coded on to byte so width up to 65536
         binh = self.binary_value(h, 16)
-        self.put_binary_value(binw) #Put width
-        self.put_binary_value(binh) #Put height
-        for h in range(imtohide.height): #Iterate the hole image to put every pixel values
-            for w in range(imtohide.width):
-                for chan in range(imtohide.channels):
-                    val = imtohide[h,w][chan]
-                    self.put_binary_value(self.byteValue(int(val)))
+        binc = self.binary_value(channels, 8) #Channels coded on one byte
+        self.put_binary_value(binw + binh + binc) #Put width, height and channels
+        self.put_bits(np.unpackbits(np.ascontiguousarray(imtohide).reshape(-1))) #Put every pixel values at once
         return self.image
 
-                    
     def decode_image(self):
         width = int(self.read_bits(16),2) #Read 16bits and convert it in int
         height = int(self.read_bits(16),2)
-        unhideimg = np.zeros((width,height, 3), np.uint8) #Create an image in which we will put all the pixels read
-        for h in range(height):
-            for w in range(width):
-                for chan in range(unhideimg.channels):
-                    val = list(unhideimg[h,w])
-                    val[chan] = int(self.read_byte(),2) #Read the value
-                    unhideimg[h,w] = tuple(val)
-        return unhideimg
-    
+        channels = int(self.read_byte(),2)
+        self.carrier.check_slots(self.tell(), 8*height*width*channels) #Size read from a clean carrier fails here, not in np.empty
+        unhideimg = np.empty(height*width*channels, np.uint8) #Flat buffer in which we will put all the pixels read
+        for offset, chunk in self.iter_bytes(len(unhideimg)):
+            unhideimg[offset:offset+len(chunk)] = np.frombuffer(chunk, np.uint8)
+        if channels == 1: #Grayscale images come back as (h,w) like cv2 loads them
+            return unhideimg.reshape(height, width)
+        return unhideimg.reshape(height, width, channels)
+
     def encode_binary(self, data):
         l = len(data)
         if self.width*self.height*self.nbchannels < l+64:
             raise SteganographyException("Carrier image not big enough to hold all the datas to steganography")
-        self.put_binary_value(self.binary_value(l, 64))
-        for byte in data:
-            byte = byte if isinstance(byte, int) else ord(byte) # Compat py2/py3
-            self.put_binary_value(self.byteValue(byte))
+        return self.encode_prepared(PreparedPayload.from_binary(data)) #Length coded on 8 bytes
+
+    def encode_prepared(self, payload): #Copy a PreparedPayload in the carrier
+        self.put_bits(payload.bits)
+        return self.image
+
+    def decode_binary(self, sink=None, chunksize=CHUNKSIZE):
+        #Without sink the payload is returned as bytes, otherwise it is written
+        #to the file-like sink chunk by chunk and its length is returned
+        l = int.from_bytes(np.packbits(self.read_bit_array(64)).tobytes(), "big")
+        return self.read_payload(l, sink, chunksize)
+
+    def encode_packed(self, data, k=2): #Hide data with k bits (1 to 4) in every channel byte
+        if k not in range(1, 5):
+            raise SteganographyException("k must be between 1 and 4")
+        if self.matching:
+            raise SteganographyException("Packed mode only supports LSB replacement")
+        if isinstance(data, str): # Compat py2/py3
+            data = data.encode("latin-1")
+        l = len(data)
+        self.carrier.check_slots(self.tell(), 72 + -(-8 * l // k), 1) #Header and payload checked before anything is written
+        self.put_binary_value(self.binary_value(k, 8) + self.binary_value(l, 64)) #k and length on the first plane
+        bits = np.unpackbits(np.frombuffer(bytes(data), np.uint8))
+        bits = np.concatenate([bits, np.zeros(-len(bits) % k, np.uint8)]).reshape(-1, k)
+        self.put_values(np.packbits(bits, axis=1).reshape(-1) >> np.uint8(8 - k), k) #k bits per slot, MSB first
         return self.image
 
-    def decode_binary(self):
+    def decode_packed(self, sink=None, chunksize=CHUNKSIZE):
+        #Same return convention as decode_binary
+        k = int(self.read_byte(), 2)
+        if k not in range(1, 5):
+            raise SteganographyException("No packed payload in this image")
         l = int(self.read_bits(64), 2)
-        output = b""
-        for i in range(l):
-            output += bytearray([int(self.read_byte(),2)])
-        return output
+        self.carrier.check_slots(self.tell(), -(-8 * l // k), 1) #A bad length fails here, before anything is allocated
+        output = None if sink is not None else bytearray(l)
+        chunksize = max(k, chunksize - chunksize % k) #8 slots hold exactly k bytes
+        for offset in range(0, l, chunksize):
+            count = min(chunksize, l - offset)
+            values = self.read_values(-(-8 * count // k), k)
+            bits = np.unpackbits(values[:, np.newaxis], axis=1)[:, 8-k:].reshape(-1)
+            chunk = np.packbits(bits[:8*count]).tobytes()
+            if sink is not None:
+                sink.write(chunk)
+            else:
+                output[offset:offset+count] = chunk
+        return l if sink is not None else bytes(output)
+
+    def iter_bytes(self, nb, chunksize=CHUNKSIZE): #Yield (offset, bytes) for the next nb bytes, chunksize bytes at a time
+        for offset in range(0, nb, chunksize):
+            count = min(chunksize, nb - offset)
+            yield offset, np.packbits(self.read_bit_array(8 * count)).tobytes()
+
+
+def embed_prepared(im, payload, key=None, matching=False, inplace=False):
+    #Stateless counterparts of the LSBSteg methods, safe to call from many
+    #threads: no cursor, the payload always starts at slot 0. They return
+    #a modified copy of im, or im itself when inplace is set
+    out = im if inplace else im.copy()
+    Carrier(out, key).write_bits(0, payload.bits, matching, np.random.default_rng())
+    return out
+
+
+def embed_binary(im, data, key=None, matching=False, inplace=False): #Same layout as LSBSteg.encode_binary
+    return embed_prepared(im, PreparedPayload.from_binary(data), key, matching, inplace)
+
+
+def embed_text(im, txt, key=None, matching=False, inplace=False): #Same layout as LSBSteg.encode_text
+    return embed_prepared(im, PreparedPayload.from_text(txt), key, matching, inplace)
+
+
+def extract_binary(im, key=None, sink=None, chunksize=CHUNKSIZE): #Same return convention as LSBSteg.decode_binary
+    carrier = Carrier(im, key)
+    l = int.from_bytes(np.packbits(carrier.read_bits(0, 64)).tobytes(), "big")
+    return carrier.read_bytes(64, l, sink, chunksize)
+
+
+def extract_text(im, key=None):
+    carrier = Carrier(im, key)
+    l = int.from_bytes(np.packbits(carrier.read_bits(0, 32)).tobytes(), "big")
+    return carrier.read_bytes(32, l).decode("utf-8")
+
+
+def embed_shards(images, data, key=None, matching=False, inplace=False, workers=None):
+    #Split data over the ordered carriers in proportion to their capacity and
+    #embed the shards in parallel. Every carrier gets a shard, possibly empty,
+    #made of SHARD_HEADER followed by its part of data. Nothing is written
+    #when the carriers cannot hold everything
+    if isinstance(data, str): # Compat py2/py3
+        data = data.encode("latin-1")
+    if len(images) >= 1 << 16:
+        raise SteganographyException("Too many carriers")
+    capacities = [(8 * Carrier(im).planesize - 1) // 8 - SHARD_HEADER.size for im in images] #0: room for an empty shard only
+    if any(cap < 0 for cap in capacities): #Checked before any thread starts, no carrier is written
+        raise SteganographyException("Carrier image not big enough to hold a shard header")
+    total = sum(capacities)
+    if total < len(data):
+        raise SteganographyException("Carrier images not big enough to hold all the datas to steganography")
+    sizes = [len(data) * cap // total if total else 0 for cap in capacities]
+    spare = [i for i, cap in enumerate(capacities) if sizes[i] < cap]
+    for i in spare[:len(data) - sum(sizes)]: #Spread the rounding remainder over carriers with room left
+        sizes[i] += 1
+    bounds = np.cumsum([0] + sizes)
+    shards = [SHARD_HEADER.pack(i, len(images), sizes[i]) + data[bounds[i]:bounds[i+1]] for i in range(len(images))]
+    def embed(args):
+        im, shard = args
+        out = im if inplace else im.copy()
+        Carrier(out, key).write_bits(0, np.unpackbits(np.frombuffer(shard, np.uint8)), matching, np.random.default_rng())
+        return out
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(embed, zip(images, shards)))
+
+
+def extract_shards(images, key=None, workers=None):
+    #Reassemble data hidden by embed_shards, whatever the order of images
+    def extract(im):
+        carrier = Carrier(im, key)
+        index, count, length = SHARD_HEADER.unpack(carrier.read_bytes(0, SHARD_HEADER.size))
+        return index, count, carrier.read_bytes(8 * SHARD_HEADER.size, length)
+    with ThreadPoolExecutor(workers) as executor:
+        shards = sorted(executor.map(extract, images), key=lambda shard: shard[0])
+    count = len(images)
+    if [shard[0] for shard in shards] != list(range(count)) or any(shard[1] != count for shard in shards):
+        raise SteganographyException("Missing or foreign shards, cannot reassemble the payload")
+    return b"".join(shard[2] for shard in shards)
+
+
+class LSBReader():
+    #Random access to a payload hidden by encode_binary: payload bits are
+    #mapped straight to their slot, no cursor is replayed from slot 0
+    HEADER_BITS = 64
+
+    def __init__(self, im, key=None):
+        self.carrier = Carrier(im, key)
+
+    def locate(self, bit): #Return (row, col, channel, plane) holding the given payload bit, header included
+        carrier = self.carrier
+        plane, pos = divmod(bit, carrier.planesize)
+        if carrier.permutation is not None:
+            pos = int(carrier.permutation[pos])
+        row, pos = divmod(pos, carrier.width * carrier.nbchannels)
+        col, chan = divmod(pos, carrier.nbchannels)
+        return row, col, chan, plane
+
+    def peek_length(self): #Payload size in bytes, read from the 64 header slots only
+        return int.from_bytes(np.packbits(self.carrier.read_bits(0, self.HEADER_BITS)).tobytes(), "big")
+
+    def read_range(self, offset, n): #Return n payload bytes starting at byte offset
+        length = self.peek_length()
+        if offset < 0 or n < 0 or offset + n > length:
+            raise SteganographyException("Range outside of the hidden payload")
+        return self.carrier.read_bytes(self.HEADER_BITS + 8 * offset, n)
+
+
+def mapped_carrier(path, mode="r"): #open_carrier, or None for a file it cannot map (e.g. 8 or 32 bits BMP) to load with cv2.imread instead
+    try:
+        return open_carrier(path, mode)
+    except SteganographyException:
+        return None
 
 
 def main():
     args = docopt.docopt(__doc__, version="0.2")
     in_f = args["--in"]
     out_f = args["--out"]
-    in_img = cv2.imread(in_f)
-    steg = LSBSteg(in_img)
+    in_ext = os.path.splitext(in_f)[1].replace(".", "").lower()
+    key = args["--key"]
+    matching = args["--matching"]
     lossy_formats = ["jpeg", "jpg"]
 
     if args['encode']:
@@ -187,13 +596,23 @@ def main():
             out_f = out_f + "." + out_ext
 
         data = open(args["--file"], "rb").read()
-        res = steg.encode_binary(data)
-        cv2.imwrite(out_f, res)
+        #Header checked before copying, other BMPs go through cv2 as before
+        if out_ext == in_ext and in_ext in MMAP_FORMATS and mapped_carrier(in_f, "r") is not None: #Copy the file and encode the copy in place
+            shutil.copyfile(in_f, out_f)
+            res = LSBSteg(open_carrier(out_f, "r+"), key, matching).encode_binary(data)
+            res.flush()
+        else:
+            res = LSBSteg(cv2.imread(in_f), key, matching).encode_binary(data)
+            cv2.imwrite(out_f, res)
 
     elif args["decode"]:
-        raw = steg.decode_binary()
+        carrier = mapped_carrier(in_f, "r") if in_ext in MMAP_FORMATS else None
+        if carrier is not None:
+            steg = LSBSteg(carrier, key)
+        else:
+            steg = LSBSteg(cv2.imread(in_f), key)
         with open(out_f, "wb") as f:
-            f.write(raw)
+            steg.decode_binary(f) #Streamed straight to the output file
 
 
 if __name__=="__main__":
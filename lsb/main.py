@@ -18,6 +18,9 @@ Integer in mauris eu nibh euismod gravida.
 Duis ac tellus et risus vulputate vehicula. Donec lobortis risus a elit. 
 Etiam tempor. Ut ullamcorper."""
 
+# Bit yang sama untuk semua cover, dihitung sekali
+secret_payload = LSBSteg.PreparedPayload.from_text(secret_text)
+
 
 def process_file(input_path, output_path, filename):
     print(f"⏳ Memproses: {filename}")
@@ -29,7 +32,7 @@ def process_file(input_path, output_path, filename):
         return
 
     steg = LSBSteg.LSBSteg(image)
-    img_encoded = steg.encode_text(secret_text)
+    img_encoded = steg.encode_prepared(secret_payload)
 
     cv2.imwrite(output_path, img_encoded)
     print(f"✅ Disimpan ke: {output_path}")